@@ -4,12 +4,16 @@ Module 1: Basic MCP Server - Starter Code
 TODO: Implement tools for analyzing git changes and suggesting PR templates
 """
 
-import json
+import asyncio
+import re
+import shutil
 import subprocess
 from pathlib import Path
+from types import MappingProxyType
 from typing import Optional
 import os
 
+import orjson
 from mcp.server.fastmcp import FastMCP
 
 # Initialize the FastMCP server
@@ -18,6 +22,9 @@ mcp = FastMCP("pr-agent")
 # PR template directory (shared across all modules)
 TEMPLATES_DIR = Path(__file__).parent.parent.parent / "templates"
 
+# Server location reported in analyze_file_changes debug output
+_SERVER_FILE_DIR = str(Path(__file__).parent)
+
 # Default PR templates
 DEFAULT_TEMPLATES = {
     "bug.md": "Bug Fix",
@@ -29,8 +36,11 @@ DEFAULT_TEMPLATES = {
     "security.md": "Security"
 }
 
-# Type mapping for PR templates
-TYPE_MAPPING = {
+# Template file paths, joined once
+_TEMPLATE_PATHS = {name: str(TEMPLATES_DIR / name) for name in DEFAULT_TEMPLATES}
+
+# Type mapping for PR templates (read-only)
+TYPE_MAPPING = MappingProxyType({
     "bug": "bug.md",
     "fix": "bug.md",
     "feature": "feature.md",
@@ -44,11 +54,234 @@ TYPE_MAPPING = {
     "performance": "performance.md",
     "optimization": "performance.md",
     "security": "security.md"
-}
+})
+
+# git executable resolved once, so spawning it doesn't walk PATH on every call
+_GIT = shutil.which("git") or "git"
+
+# Read size used when streaming git diff output
+_DIFF_CHUNK_SIZE = 64 * 1024
+
+# Plain diff output: no color codes, no user ext-diff/textconv drivers, and no
+# rename detection (its similarity scan is quadratic in the number of changed files)
+_GIT_DIFF_FLAGS = ["--no-color", "--no-ext-diff", "--no-renames"]
+
+# Histogram diff is faster than the default Myers on source code and yields tighter hunks
+_GIT_DIFF_CONFIG = ["-c", "diff.algorithm=histogram"]
+
+# "added<TAB>deleted<TAB>path" records from git diff -z --numstat ("-" for binary files);
+# with -z paths are emitted verbatim and may contain newlines
+_NUMSTAT_RE = re.compile(r"(\d+|-)\t(\d+|-)\t(.*)", re.DOTALL)
+
+# Template records (filename, type, content) keyed by filename, read once at import
+_TEMPLATE_CACHE_BY_NAME: dict[str, dict] = {}
+# Template records keyed by lowercase change type, plus the fallback for unknown types
+_TEMPLATE_BY_TYPE_KEY: dict[str, dict] = {}
+_DEFAULT_TEMPLATE: Optional[dict] = None
+# Serialized get_pr_templates response; templates never change within a process
+_TEMPLATES_JSON: str = ""
+
+
+def _load_templates() -> None:
+    """Read every default template from disk into _TEMPLATE_CACHE_BY_NAME."""
+    for template_name, template_type in DEFAULT_TEMPLATES.items():
+        with open(_TEMPLATE_PATHS[template_name], encoding="utf-8") as template_file:
+            content = template_file.read()
+        _TEMPLATE_CACHE_BY_NAME[template_name] = {
+            "filename": template_name,
+            "type": template_type,
+            "content": content
+        }
+
+
+def _build_templates_json() -> str:
+    """Serialize the cached templates in the get_pr_templates output format."""
+    return orjson.dumps(list(_TEMPLATE_CACHE_BY_NAME.values()), option=orjson.OPT_INDENT_2).decode()
+
+
+try:
+    _load_templates()
+    _TEMPLATE_BY_TYPE_KEY.update(
+        {change_type: _TEMPLATE_CACHE_BY_NAME[name] for change_type, name in TYPE_MAPPING.items()}
+    )
+    _DEFAULT_TEMPLATE = _TEMPLATE_CACHE_BY_NAME["feature.md"]
+    _TEMPLATES_JSON = _build_templates_json()
+except Exception as e:
+    # Don't crash the server on import; get_pr_templates reports the error
+    _TEMPLATES_JSON = orjson.dumps({"error": str(e)}).decode()
+
+
+async def _kill_git(proc: asyncio.subprocess.Process) -> None:
+    """Kill a git process that is still running and reap it."""
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+
+async def _run_git(args: list[str], cwd: str) -> bytes:
+    """Run a git command without blocking the event loop and return its stdout."""
+    proc = await asyncio.create_subprocess_exec(
+        _GIT, *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        cwd=cwd
+    )
+    try:
+        stdout, _ = await proc.communicate()
+    except BaseException:
+        # Cancelled while git was running: don't leave it running or unreaped
+        await _kill_git(proc)
+        raise
+    return stdout
+
+
+async def _wait_git(proc: asyncio.subprocess.Process, args: list[str], stderr_task: asyncio.Task) -> None:
+    """Wait for a streamed git process, raising CalledProcessError if it failed."""
+    stderr = await stderr_task
+    returncode = await proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(
+            returncode, [_GIT, *args],
+            stderr=stderr.decode('utf-8', errors='replace')
+        )
+
+
+async def _read_capped_diff(args: list[str], cwd: str, max_lines: int) -> tuple[bytes, bytes, int]:
+    """Stream a 'git diff -z --raw --numstat [--patch]' and keep only what the response needs.
+
+    Returns the raw/numstat block, the first max_lines lines of the patch and the
+    total number of patch lines. Anything past max_lines is counted but never stored.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        _GIT, *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd
+    )
+    # Drain stderr alongside stdout so git can't block on a full stderr pipe
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    try:
+        return await _consume_capped_diff(proc, args, stderr_task, max_lines)
+    except BaseException:
+        # Cancelled or failed mid-stream: don't leave git running or unreaped
+        await _kill_git(proc)
+        stderr_task.cancel()
+        raise
+
+
+async def _consume_capped_diff(
+    proc: asyncio.subprocess.Process, args: list[str], stderr_task: asyncio.Task, max_lines: int
+) -> tuple[bytes, bytes, int]:
+    """Read the output of a git diff started by _read_capped_diff."""
+    # The NUL-terminated raw/numstat block is separated from the patch by an extra NUL
+    buffer = bytearray()
+    patch_start = -1
+    while patch_start < 0:
+        chunk = await proc.stdout.read(_DIFF_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        # Only scan the new chunk, plus one byte in case the separator straddles chunks
+        separator = buffer.find(b"\0\0", max(0, len(buffer) - len(chunk) - 1))
+        if separator >= 0:
+            patch_start = separator + 2
+
+    if patch_start < 0:
+        # No patch: everything git printed is the raw/numstat block
+        await _wait_git(proc, args, stderr_task)
+        return bytes(buffer), b"", 0
+
+    header = bytes(buffer[:patch_start - 1])
+    patch = buffer[patch_start:]
+    del buffer
+
+    # Buffer the patch only until max_lines complete lines are available
+    newlines = patch.count(b"\n")
+    while newlines < max_lines:
+        chunk = await proc.stdout.read(_DIFF_CHUNK_SIZE)
+        if not chunk:
+            break
+        patch += chunk
+        newlines += chunk.count(b"\n")
+
+    if newlines < max_lines:
+        await _wait_git(proc, args, stderr_task)
+        total_lines = newlines + (1 if patch and not patch.endswith(b"\n") else 0)
+        return header, bytes(patch), total_lines
+
+    # Cut after the max_lines-th line and only count what follows
+    cut = -1
+    for _ in range(max_lines):
+        cut = patch.find(b"\n", cut + 1)
+    kept = bytes(patch[:max(cut, 0)])
+    rest = patch[cut + 1:]
+    remaining_lines = rest.count(b"\n")
+    last_byte = rest[-1:]
+    while chunk := await proc.stdout.read(_DIFF_CHUNK_SIZE):
+        remaining_lines += chunk.count(b"\n")
+        last_byte = chunk[-1:]
+    await _wait_git(proc, args, stderr_task)
+
+    if last_byte and last_byte != b"\n":
+        remaining_lines += 1
+    if remaining_lines == 0:
+        # Exactly max_lines lines: nothing was cut off
+        kept = bytes(patch)
+    return header, kept, max_lines + remaining_lines
+
+
+def _parse_diff_header(header: bytes) -> tuple[list[dict], str, str]:
+    """Parse a 'git diff -z --raw --numstat' block.
+
+    Returns the changed files as {status, path} records, the same list in
+    name-status text form, and the statistics summary.
+    """
+    if not header:
+        # Branch has no changes against the base: nothing to decode or parse
+        return [], "", ""
+
+    files = []
+    file_stats = []
+    insertions = deletions = 0
+    fields = header.decode('utf-8', errors='replace').split("\0")
+    index = 0
+    while index < len(fields):
+        field = fields[index]
+        index += 1
+        if field.startswith(":"):
+            # ":<old mode> <new mode> <old sha> <new sha> <status>" then the path field
+            files.append({"status": field.rsplit(" ", 1)[-1], "path": fields[index]})
+            index += 1
+            continue
+        match = _NUMSTAT_RE.fullmatch(field)
+        if not match:
+            continue
+        added, deleted, path = match.groups()
+        if added == "-":
+            file_stats.append(f" {path} | Bin")
+        else:
+            insertions += int(added)
+            deletions += int(deleted)
+            file_stats.append(f" {path} | {int(added) + int(deleted)}")
+
+    files_changed = "".join(f"{file['status']}\t{file['path']}\n" for file in files)
+    if not file_stats:
+        return files, files_changed, ""
+
+    summary = f" {len(file_stats)} file{'s' if len(file_stats) != 1 else ''} changed"
+    if insertions:
+        summary += f", {insertions} insertion{'s' if insertions != 1 else ''}(+)"
+    if deletions:
+        summary += f", {deletions} deletion{'s' if deletions != 1 else ''}(-)"
+    statistics = "\n".join(file_stats + [summary]) + "\n"
+    return files, files_changed, statistics
 
 
 @mcp.tool()
-async def analyze_file_changes(base_branch: str = "main", max_diff_lines: int = 500, include_diff: bool = True, working_directory: Optional[str] = None) -> str:
+async def analyze_file_changes(base_branch: str = "main", max_diff_lines: int = 500, include_diff: bool = True, working_directory: Optional[str] = None, debug: bool = False) -> str:
     """Get the full diff and list of changed files in the current git repository.
 
     Args:
@@ -56,129 +289,111 @@ async def analyze_file_changes(base_branch: str = "main", max_diff_lines: int =
         max_diff_lines: Maximum number of diff lines to return because Large diffs can easily exceed this (default: 500)
         include_diff: Include the full diff content (default: true)
         working_directory: Optional working directory to run git commands in (default: None, uses MCP roots or server CWD)
+        debug: Include a _debug section describing how the working directory was resolved (default: false)
     """
     try:
-        # Try to get working directory from roots first
-        if working_directory is None:
+        # Ask the client for its roots once, and only when something needs them;
+        # the result serves both the working directory lookup and the debug output
+        roots_result = None
+        roots_error = None
+        if working_directory is None or debug:
             try:
                 context = mcp.get_context()
                 roots_result = await context.session.list_roots()
-                # Get the first root - Claude Code sets this to the CWD
-                root = roots_result.roots[0]
-                # FileUrl object has a .path property that gives us the path directly
-                working_directory = root.uri.path
-            except Exception:
-                # If we can't get roots, fall back to current directory
-                pass
+            except Exception as e:
+                roots_error = str(e)
+
+        # Try to get working directory from roots first
+        if working_directory is None and roots_result is not None and roots_result.roots:
+            # Get the first root - Claude Code sets this to the CWD
+            # FileUrl object has a .path property that gives us the path directly
+            working_directory = roots_result.roots[0].uri.path
 
         # Use provided working directory or current directory
         cwd = working_directory if working_directory else os.getcwd()
 
         # Debug output
-        debug_info = {
-            "provided_working_directory": working_directory,
-            "actual_cwd": cwd,
-            "server_process_cwd": os.getcwd(),
-            "server_file_location": str(Path(__file__).parent),
-            "roots_check": None
-        }
-
-        # Add roots debug info
-        try:
-            context = mcp.get_context()
-            roots_result = await context.session.list_roots()
-            debug_info["roots_check"] = {
-                "found": True,
-                "count": len(roots_result.roots),
-                "roots": [str(root.uri) for root in roots_result.roots]
-            }
-        except Exception as e:
-            debug_info["roots_check"] = {
-                "found": False,
-                "error": str(e)
+        debug_info = None
+        if debug:
+            debug_info = {
+                "provided_working_directory": working_directory,
+                "actual_cwd": cwd,
+                "server_process_cwd": os.getcwd(),
+                "server_file_location": _SERVER_FILE_DIR,
+                "roots_check": None
             }
 
-        # Get list of changed files
-        files_result = subprocess.run(
-            ["git", "diff", "--name-status", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            check=True,
-            cwd=cwd
-        )
+            # Add roots debug info
+            if roots_result is not None:
+                debug_info["roots_check"] = {
+                    "found": True,
+                    "count": len(roots_result.roots),
+                    "roots": [str(root.uri) for root in roots_result.roots]
+                }
+            else:
+                debug_info["roots_check"] = {
+                    "found": False,
+                    "error": roots_error
+                }
 
-        # Get diff statistics
-        stat_result = subprocess.run(
-            ["git", "diff", "--stat", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
+        revision_range = f"{base_branch}...HEAD"
+
+        # Changed files, per-file counts and the patch all come from one git diff
+        diff_args = [*_GIT_DIFF_CONFIG, "diff", *_GIT_DIFF_FLAGS, "-z", "--raw", "--numstat"]
+        if include_diff:
+            diff_args.append("--patch")
+        diff_args.append(revision_range)
+
+        # Run the independent git commands concurrently; wait for both even if
+        # one fails so neither git process is left behind
+        diff_result, commits = await asyncio.gather(
+            _read_capped_diff(diff_args, cwd, max_diff_lines),
+            _run_git(["log", "--no-color", "--oneline", f"{base_branch}..HEAD"], cwd),
+            return_exceptions=True
         )
+        for result in (diff_result, commits):
+            if isinstance(result, BaseException):
+                raise result
+        header, diff_bytes, total_diff_lines = diff_result
+        files, files_changed, statistics = _parse_diff_header(header)
 
         # Get the actual diff if requested
         diff_content = ""
         truncated = False
         if include_diff:
-            diff_result = subprocess.run(
-                ["git", "diff", f"{base_branch}...HEAD"],
-                capture_output=True,
-                text=True,
-                cwd=cwd
-            )
-            diff_lines = diff_result.stdout.split('\n')
-
-            # Check if we need to truncate
-            if len(diff_lines) > max_diff_lines:
-                diff_content = '\n'.join(diff_lines[:max_diff_lines])
-                diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {len(diff_lines)} lines ..."
+            diff_content = diff_bytes.decode('utf-8', errors='replace')
+
+            # Only the first max_diff_lines lines were kept
+            if total_diff_lines > max_diff_lines:
+                diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {total_diff_lines} lines ..."
                 diff_content += "\n... Use max_diff_lines parameter to see more ..."
                 truncated = True
-            else:
-                diff_content = diff_result.stdout
-
-        # Get commit messages for context
-        commits_result = subprocess.run(
-            ["git", "log", "--oneline", f"{base_branch}..HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
 
         analysis = {
             "base_branch": base_branch,
-            "files_changed": files_result.stdout,
-            "statistics": stat_result.stdout,
-            "commits": commits_result.stdout,
+            "files_changed": files_changed,
+            "files": files,
+            "statistics": statistics,
+            "commits": commits.decode('utf-8', errors='replace'),
             "diff": diff_content if include_diff else "Diff not included (set include_diff=true to see full diff)",
             "truncated": truncated,
-            "total_diff_lines": len(diff_lines) if include_diff else 0,
-            "_debug": debug_info
+            "total_diff_lines": total_diff_lines
         }
+        if debug_info is not None:
+            analysis["_debug"] = debug_info
 
-        return json.dumps(analysis, indent=2)
+        return orjson.dumps(analysis, option=orjson.OPT_INDENT_2).decode()
 
     except subprocess.CalledProcessError as e:
-        return json.dumps({"error": f"Git error: {e.stderr}"})
+        return orjson.dumps({"error": f"Git error: {e.stderr}"}).decode()
     except Exception as e:
-        return json.dumps({"error": str(e)})
+        return orjson.dumps({"error": str(e)}).decode()
 
 
 @mcp.tool()
 async def get_pr_templates() -> str:
     """List available PR templates with their content."""
-
-    try:
-        templates = [  # Example output structure:]
-            {
-                "filename": template_name,
-                "type": template_type,
-                "content": (TEMPLATES_DIR / template_name).read_text()
-            }
-            for template_name, template_type in DEFAULT_TEMPLATES.items()
-        ]
-        return json.dumps(templates, indent=2)
-    except Exception as e:
-        return json.dumps({"error": str(e)})
+    return _TEMPLATES_JSON
 
 
 @mcp.tool()
@@ -190,20 +405,8 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
         change_type: The type of change you've identified (bug, feature, docs, refactor, test, etc.)
     """
     try:
-        # Get available templates
-        templates_response = await get_pr_templates()
-        templates = json.loads(templates_response)
-
         # mapping template with change_type
-        template_type = TYPE_MAPPING.get(change_type.lower(), "feature.md")
-        template_with_relative_type = templates.get(template_type, "").lower()
-        for template in templates:
-            if template["filename"] == template_type:
-                relative_template = template
-                break
-            else:
-                # Default to first template if not found
-                relative_template = templates[0]
+        relative_template = _TEMPLATE_BY_TYPE_KEY.get(change_type.lower(), _DEFAULT_TEMPLATE)
         suggestion = {
             "recommended_template": relative_template,
             "reasoning": f"Based on your analysis: '{changes_summary}', this appears to be a {change_type} change.",
@@ -218,9 +421,9 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
             "template_content": "template_content",
             "suggestion": "Claude can help you fill out this template based on the specific changes in your PR."
         }
-        return json.dumps(suggestion, indent=2)
+        return orjson.dumps(suggestion, option=orjson.OPT_INDENT_2).decode()
 
-    return json.dumps(suggestion, indent=2)
+    return orjson.dumps(suggestion, option=orjson.OPT_INDENT_2).decode()
 
 
 if __name__ == "__main__":
@@ -8,7 +8,7 @@ import json
 import pytest
 import asyncio
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 # Import your implemented functions
 try:
@@ -24,6 +24,19 @@ except ImportError as e:
     IMPORT_ERROR = str(e)
 
 
+def fake_git_process(stdout: bytes = b"", returncode: int = 0):
+    """Build a stand-in for asyncio.create_subprocess_exec's process object."""
+    reader = asyncio.StreamReader()
+    reader.feed_data(stdout)
+    reader.feed_eof()
+    stderr = asyncio.StreamReader()
+    stderr.feed_eof()
+    process = MagicMock(stdout=reader, stderr=stderr, returncode=returncode)
+    process.communicate = AsyncMock(return_value=(stdout, b""))
+    process.wait = AsyncMock(return_value=returncode)
+    return process
+
+
 class TestImplementation:
     """Test that the required functions are implemented."""
 
@@ -46,8 +59,8 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_returns_json_string(self):
         """Test that analyze_file_changes returns a JSON string."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(stdout="", stderr="")
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = lambda *args, **kwargs: fake_git_process()
 
             result = await analyze_file_changes()
 
@@ -59,9 +72,9 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_includes_required_fields(self):
         """Test that the result includes expected fields."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(
-                stdout="M\tfile1.py\n", stderr="")
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = lambda *args, **kwargs: fake_git_process(
+                b"M\tfile1.py\n")
 
             result = await analyze_file_changes()
             data = json.loads(result)
@@ -78,6 +91,151 @@ class TestAnalyzeFileChanges:
                 assert isinstance(
                     data, dict), "Should return a JSON object even if not implemented"
 
+    @pytest.mark.asyncio
+    async def test_output_limiting(self):
+        """Test that large diffs are properly truncated."""
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            # Create a mock raw/numstat block followed by a diff with many lines
+            large_diff = "\n".join([f"+ line {i}" for i in range(1000)])
+            header = "\0".join([
+                ":100644 100644 abc1234 def5678 M", "file1.py",  # raw record
+                "1000\t0\tfile1.py", ""  # numstat record
+            ])
+
+            mock_exec.side_effect = [
+                fake_git_process(f"{header}\0{large_diff}".encode()),  # files, stats + diff
+                fake_git_process(b"abc123 Initial commit")  # commits
+            ]
+
+            # Test with default limit (500 lines)
+            result = await analyze_file_changes(include_diff=True)
+            data = json.loads(result)
+
+            diff_lines = data["diff"].split('\n')
+            assert len(diff_lines) < 600, "Large diffs should be truncated"
+            assert data["truncated"] == True, "Should indicate truncation"
+            assert data["total_diff_lines"] == 1000, "Should report the full diff size"
+            assert data["files_changed"] == "M\tfile1.py\n", "Should list changed files"
+            assert data["files"] == [{"status": "M", "path": "file1.py"}], \
+                "Should include a structured file list"
+            assert "1 file changed, 1000 insertions(+)" in data["statistics"], \
+                "Should include diff statistics"
+
+    @pytest.mark.asyncio
+    async def test_paths_with_newlines_and_tabs(self):
+        """Test that -z output keeps paths containing newlines and tabs intact."""
+        header = (
+            ":000000 100644 0000000 abc1234 A\0we\nird\tname\0"
+            "1\t0\twe\nird\tname\0\0"
+        )
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = [
+                fake_git_process(f"{header}+ line\n".encode()),
+                fake_git_process()
+            ]
+
+            data = json.loads(await analyze_file_changes(working_directory="."))
+
+            assert data["files"] == [{"status": "A", "path": "we\nird\tname"}], \
+                "Path should be kept verbatim"
+            assert data["statistics"] == " we\nird\tname | 1\n 1 file changed, 1 insertion(+)\n", \
+                "Stats line should use the full path"
+
+    @pytest.mark.asyncio
+    async def test_git_runs_without_blocking(self):
+        """Test that git is run through asyncio subprocesses, never subprocess.run."""
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec, \
+                patch('subprocess.run') as mock_run:
+            mock_exec.side_effect = lambda *args, **kwargs: fake_git_process()
+
+            data = json.loads(await analyze_file_changes(working_directory="."))
+
+            assert "error" not in data, "Should succeed with async git processes"
+            assert not mock_run.called, "Blocking subprocess.run would stall the event loop"
+            assert mock_exec.call_count == 2, "Diff and log should be launched together"
+
+    @pytest.mark.asyncio
+    async def test_diff_skips_rename_detection(self):
+        """Test that the diff is run without rename detection."""
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = lambda *args, **kwargs: fake_git_process()
+
+            await analyze_file_changes(working_directory=".")
+
+            diff_args = mock_exec.call_args_list[0].args
+            assert "diff" in diff_args, "First git call should be the diff"
+            assert "--no-renames" in diff_args, "Rename detection should be disabled"
+
+    @pytest.mark.asyncio
+    async def test_failed_stream_kills_git(self):
+        """Test that git is killed and reaped if reading its output fails."""
+        broken = fake_git_process(returncode=None)
+        broken.stdout = MagicMock(read=AsyncMock(side_effect=OSError("read failed")))
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = [broken, fake_git_process()]
+
+            data = json.loads(await analyze_file_changes(working_directory="."))
+
+            assert data == {"error": "read failed"}, "The read error should be reported"
+            broken.kill.assert_called_once()
+            broken.wait.assert_awaited()
+
+    @pytest.mark.asyncio
+    async def test_header_split_across_chunks(self):
+        """Test that the header/patch separator is found when it straddles two reads."""
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec, \
+                patch('server._DIFF_CHUNK_SIZE', 13):
+            # "1\t0\tfile1.py\0" is 13 bytes, so the second NUL starts the next read
+            mock_exec.side_effect = [
+                fake_git_process(b"1\t0\tfile1.py\0\0+ line\n"),
+                fake_git_process()
+            ]
+
+            data = json.loads(await analyze_file_changes(working_directory="."))
+
+            assert data["diff"] == "+ line\n", "Patch should start after the separator"
+            assert "1 file changed" in data["statistics"], "Header should be parsed"
+
+    @pytest.mark.asyncio
+    async def test_total_diff_lines_counts_lines(self):
+        """Test that total_diff_lines counts diff lines, not newline-split pieces."""
+        small_diff = "".join(f"+ line {i}\n" for i in range(10))
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = [
+                fake_git_process(f"1\t0\tfile1.py\0\0{small_diff}".encode()),
+                fake_git_process()
+            ]
+
+            data = json.loads(await analyze_file_changes(working_directory=".", max_diff_lines=10))
+
+            assert data["total_diff_lines"] == 10, "A trailing newline should not add a line"
+            assert data["truncated"] == False, "A diff of exactly max_diff_lines is not truncated"
+            assert data["diff"] == small_diff, "The untruncated diff should be returned as-is"
+
+    @pytest.mark.asyncio
+    async def test_no_changes(self):
+        """Test that a branch with no changes yields an empty analysis."""
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = lambda *args, **kwargs: fake_git_process()
+
+            data = json.loads(await analyze_file_changes(working_directory="."))
+
+            assert data["files_changed"] == "", "No files should be listed"
+            assert data["statistics"] == "", "No statistics should be reported"
+            assert data["diff"] == "" and data["total_diff_lines"] == 0, "Diff should be empty"
+
+    @pytest.mark.asyncio
+    async def test_debug_info_is_opt_in(self):
+        """Test that the _debug section is only returned when requested."""
+        with patch('asyncio.create_subprocess_exec', new_callable=AsyncMock) as mock_exec:
+            mock_exec.side_effect = lambda *args, **kwargs: fake_git_process()
+
+            data = json.loads(await analyze_file_changes(working_directory="."))
+            assert "_debug" not in data, "Debug info should be omitted by default"
+
+            data = json.loads(await analyze_file_changes(working_directory=".", debug=True))
+            assert data["_debug"]["actual_cwd"] == ".", "Debug info should describe the resolved cwd"
+
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestGetPRTemplates:
@@ -165,6 +323,19 @@ class TestSuggestTemplate:
             assert isinstance(
                 suggestion, dict), "Should return structured error for starter code"
 
+    @pytest.mark.asyncio
+    async def test_selects_template_for_change_type(self):
+        """Test that the mapped template is chosen, falling back to feature.md."""
+        result = await suggest_template("Updated the README", "Docs")
+        suggestion = json.loads(result)
+        assert suggestion["recommended_template"]["filename"] == "docs.md", \
+            "Should pick the template mapped to the change type"
+
+        result = await suggest_template("Something else", "unknown")
+        suggestion = json.loads(result)
+        assert suggestion["recommended_template"]["filename"] == "feature.md", \
+            "Unknown change types should default to the feature template"
+
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestToolRegistration: